@@ -14,43 +14,162 @@
 
 '''
 
+import os
 import json
+import hashlib
+import tempfile
 import requests
-import pprint
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import ipaddress
 import re
 
+#- orjson decodes large responses (like the _ALL lists) a lot faster
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
 #- start anonymous; for full API, use pdb_set_credentials()
 
 PDB_baseurl = "https://peeringdb.com/api"
 
+#- one shared session, so all queries reuse pooled keep-alive connections
+#  instead of doing a new TCP+TLS handshake for each request
+_session = requests.Session()
+_session.headers.update({"Accept": "application/json"})
+
+#- retry transient failures (and rate limiting) with backoff, honouring
+#  Retry-After, instead of giving up on a long run halfway through; once
+#  out of retries, hand back the last response so callers see its status
+_retry = Retry(total=5, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False)
+_session.mount("https://", HTTPAdapter(max_retries=_retry))
+
+#- where querypdb(url, revalidate=True) keeps responses between runs
+PDB_cachedir = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "pdb-intersect")
+
+#- upper bound for parallel queries issued by the library (see pdb_parallel())
+PDB_max_workers = 8
+
+#- leading zeros of an address part; keeps a lone "0", and "" from "::"
+_LEADING_ZEROS = re.compile(r"^0+(?=.)")
+
+#- trailing all-zero quads of a (partial) IPv6 address, see getixp_by_ipv6()
+_TRAILING_ZERO_QUADS = re.compile(r"(:0)+$")
+
 
 def pdb_set_credentials(arguser,argpass):
-    global PDB_baseurl
-    PDB_baseurl = "https://{}:{}@peeringdb.com/api".format(arguser,argpass)
+    global _ixpfx_lpm
+    _session.auth = (arguser,argpass)
+    _cached_get.cache_clear()       # results may differ once authenticated
+    _ixpfx_lpm = None               # and so may the ixpfx index built from them
 
 
 #-
 # Run a reading query
+#
+# Results are cached per URL, so repeated lookups of the same object don't
+# hit the network (nor PeeringDB's rate limits) again. The returned hashes
+# are shared between callers - don't modify them in place.
 
-def querypdb(url):
-    pdb_json = requests.get(url=url)
-    pdb_dict = json.loads(pdb_json.text)
+#
+# With revalidate=True, the response is also kept on disk (see PDB_cachedir)
+# along with its ETag, and later runs send If-None-Match: if the server says
+# "304 Not Modified", the stored copy is used instead of downloading it all
+# again. Meant for the big, slowly changing _ALL lists.
+
+@lru_cache(maxsize=2048)
+def _cached_get(url, revalidate=False):
+    if revalidate: return _revalidated_get(url)
+
+    pdb_json = _session.get(url=url, timeout=30)
+    pdb_json.raise_for_status()         # don't try to parse an error page
+    pdb_dict = json_loads(pdb_json.content)       # bytes, skip decoding to str
     return pdb_dict
 
+def _revalidated_get(url):
+    #- results may differ per user, so they get their own copies
+    user = _session.auth[0] if _session.auth else ""
+    key = hashlib.sha1("{}@{}".format(user, url).encode()).hexdigest()
+    path = os.path.join(PDB_cachedir, key)
+
+    #- ETag and body live in one file (ETag line first), so they are always
+    #  replaced together and can't get mixed up between overlapping runs
+    headers = {}
+    stored = None
+    try:
+        with open(path, "rb") as f: (etag, stored) = f.read().split(b"\n", 1)
+        headers["If-None-Match"] = etag.decode()
+    except (OSError, ValueError):
+        pass
+
+    pdb_json = _session.get(url=url, headers=headers, timeout=30)
+    if pdb_json.status_code == 304:
+        try:
+            return json_loads(stored)
+        except ValueError:
+            #- stored copy is broken, fetch it all after all
+            pdb_json = _session.get(url=url, timeout=30)
+
+    pdb_json.raise_for_status()         # don't try to parse an error page
+    pdb_dict = json_loads(pdb_json.content)
+
+    etag = pdb_json.headers.get("ETag")
+    if etag:
+        try:
+            os.makedirs(PDB_cachedir, mode=0o700, exist_ok=True)   # per-user data
+            _write_replace(path, etag.encode()+b"\n"+pdb_json.content)
+        except OSError:
+            pass                        # no cache then, still got the data
+
+    return pdb_dict
+
+def _write_replace(path, data):
+    ''' writes data to path atomically, readers never see a partial file;
+        the temp file is unique, so concurrent writers don't clash
+    '''
+    (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f: f.write(data)
+        os.replace(tmppath, path)
+    except OSError:
+        os.unlink(tmppath)
+        raise
+
+def querypdb(url, revalidate=False):
+    return _cached_get(url, revalidate)
+
+
+def pdb_parallel(func, *iterables):
+    ''' runs func over the argument lists in parallel threads, like map(),
+        so independent queries wait for the slowest instead of for the sum
+        of all of them; returns the results as a list, in argument order
+    '''
+    with ThreadPoolExecutor(max_workers=PDB_max_workers) as pool:
+        return list(pool.map(func, *iterables))
+
 
 #-
 # Do an update
 
 def updatepdb(url,dict_obj):
+    global _ixpfx_lpm
     dict_headers = {
-            "Accept"       : "application/json",
             "Content-Type" : "application/json",
             }
 
-    result = requests.put(url=url, data=json.dumps(dict_obj), headers=dict_headers)
+    result = _session.put(url=url, data=json.dumps(dict_obj), headers=dict_headers, timeout=30)
+    _cached_get.cache_clear()       # whatever we read before may be stale now
+    _ixpfx_lpm = None
 
     if not result:
+        import pprint                   # only needed here
         print("PUT encountered problems:")
         pprint.pprint(result.json())
 
@@ -103,6 +222,14 @@ def pdb_net_by_orgid(orgid):
     url = PDB_baseurl+"/net?org_id={}".format(orgid)
     return querypdb(url)
 
+def pdb_net_by_asnlist(asn):
+    url = PDB_baseurl+"/net?asn__in={}".format(asn)
+    return querypdb(url)
+
+def pdb_net_by_orgidlist(orgid):
+    url = PDB_baseurl+"/net?org_id__in={}".format(orgid)
+    return querypdb(url)
+
 def pdb_net_by_orgid_and_name(orgid, name):
     url = PDB_baseurl+"/net?org_id={}&name__contains={}".format(orgid, name)
     return querypdb(url)
@@ -114,6 +241,10 @@ def pdb_org_by_id(id):
     url = PDB_baseurl+"/org?id={}".format(id)
     return querypdb(url)
 
+def pdb_org_by_idlist(id):
+    url = PDB_baseurl+"/org?id__in={}".format(id)
+    return querypdb(url)
+
 
 #-- poc
 
@@ -150,7 +281,7 @@ def pdb_ixlan_by_ixpfxid(id):
 
 def pdb_ixlan_ALL():
     url = PDB_baseurl+"/ixlan"
-    return querypdb(url)
+    return querypdb(url, revalidate=True)
 
 
 #-- netixlan
@@ -184,7 +315,7 @@ def getixpfxlist_by_partial(partial):
 
 def pdb_ixpfx_ALL():
     url = PDB_baseurl+"/ixpfx"
-    return querypdb(url)
+    return querypdb(url, revalidate=True)
 
 
 #-
@@ -195,10 +326,10 @@ def find_ixpfx_by_ixid(id):
         returns a list of ixpfx "data" hashes, not
         the pdb_ construct like pdb_ functions
     '''
-    ixlans = getixlan_by_ixid(id)
+    ixlans = pdb_ixlan_by_ixid(id)
+    ixlanids = [ixlan["id"] for ixlan in ixlans["data"]]
     ixpfxs = []
-    for ixlan in ixlans["data"]:
-        ixpfx = getixpfx_by_ixlanid(ixlan["id"])
+    for ixpfx in pdb_parallel(pdb_ixpfx_by_ixlanid, ixlanids):
         for ixpfxpart in ixpfx["data"]:
             ixpfxs.append(ixpfxpart)
     return ixpfxs
@@ -210,23 +341,63 @@ def one_ixp_by_ixpfx(ixpfx):
         returns the ix object hash without meta/data stuff
     '''
     # get the list of ixlans that ixpfx comes from
-    ixlans=getixlan_by_id(ixpfx["ixlan_id"])["data"]
+    ixlans=pdb_ixlan_by_id(ixpfx["ixlan_id"])["data"]
     if len(ixlans) == 0: return None
 
     # now get the ix from only the first ixlan found
-    ixp = getixp_by_id(ixlans[0]["ix_id"])
+    ixp = pdb_ix_by_id(ixlans[0]["ix_id"])
 
     if len(ixp["data"])>0: return ixp["data"][0]
 
 
 
+#- Matching addresses against prefixes is done on plain ints, not on
+#  ipaddress network objects, which are expensive to construct. Parsed
+#  prefixes are cached, since the same ones come up over and over.
+
+@lru_cache(maxsize=None)
+def _parse_prefix(prefix):
+    ''' parses an ixpfx "prefix" string like "192.0.2.0/24"
+        returns (version, prefixlen, network address as int), or None
+    '''
+    try:
+        (addr, prefixlen) = prefix.split("/")
+        addr = ipaddress.ip_address(addr)
+        prefixlen = int(prefixlen)
+    except ValueError:
+        return None
+
+    if not 0 <= prefixlen <= addr.max_prefixlen: return None
+    return (addr.version, prefixlen, int(addr) & _netmask(addr.max_prefixlen, prefixlen))
+
+
+def _netmask(bits, prefixlen):
+    return ((1 << prefixlen) - 1) << (bits - prefixlen)
+
+
+def _first_ixpfx_covering(addr, data):
+    ''' returns the first ixpfx hash in data whose prefix covers the
+        ipaddress object addr, or None
+    '''
+    addrint = int(addr)
+    for ixpfx in data:
+        pfx = _parse_prefix(ixpfx["prefix"])
+        if pfx == None: continue
+
+        (version, prefixlen, netint) = pfx
+        if version != addr.version: continue
+        if addrint & _netmask(addr.max_prefixlen, prefixlen) == netint: return ixpfx
+
+    return None
+
+
 def getixp_by_ipv4(v4):
     ''' Find the ix object that links (indirectly) to the
         IPv4 address given; uses the base /16 for limiting
         the search, then checks all returned objects.
         returns one ix object hash (without meta/data stuff), or None
     '''
-    v4net = ipaddress.ip_network(v4+"/32")
+    v4add = ipaddress.IPv4Address(v4)
     v4arr = v4.split(".")
     v4partial = v4arr[0]+"."+v4arr[1]                       # just use /16
 
@@ -234,18 +405,10 @@ def getixp_by_ipv4(v4):
     data = getixpfxlist_by_partial(v4partial)["data"]
 
     # find first ixpfx that is a supernet of v4
-    ixpfx=None
-    for ixpfx in data:
-        try:
-            net = ipaddress.ip_network(ixpfx["prefix"])
-        except:
-            continue
-
-        if v4net.subnet_of(net): break
-
+    ixpfx = _first_ixpfx_covering(v4add, data)
     if ixpfx==None: return None
 
-    return getixp_by_ixpfx(ixpfx)
+    return one_ixp_by_ixpfx(ixpfx)
 
 
 #- IPv6... hmm... più difficile...
@@ -266,47 +429,23 @@ def getixp_by_ipv6(v6):
         then checks all returned objects
         returns one ix object hash (without meta/data stuff), or None
     '''
-    v6net = ipaddress.ip_network(v6+"/128")
     v6add = ipaddress.ip_address(v6)
     v6full = v6add.exploded
 
-    v6arr = v6full.split(":")[0:6]
-
     #--
-    # a little bit of array string manipulation ;-)
-    # - walk all parts in v6arr, back-to-front (reversed)
-    #    ignore "0000" while still at the end of the array (atend=True)
-    #    trim the leading "0"s from each part
-    #    but set empty parts to "0"
-    #    insert to front of resultarray
-
-    resultarr = []
-    atend=True
-    for part in reversed(v6arr):
-        if part == "0000" and atend: continue
-        atend=False
-        part = re.sub("^0+","",part)
-        if part == "": part="0"
-        resultarr.insert(0,part)
-
-    v6partial = ":".join(resultarr[0:6])
+    # first 6 quads with leading "0"s trimmed (but empty ones set to "0"),
+    # then the trailing ":0" quads dropped
+    v6arr = [part.lstrip("0") or "0" for part in v6full.split(":")[0:6]]
+    v6partial = _TRAILING_ZERO_QUADS.sub("", ":".join(v6arr))
 
     #--
     # get list of ixpfx that match our slash16
     data = getixpfxlist_by_partial(v6partial)["data"]
 
     # find first ixpfx that is a supernet in v6
-    ixpfx=None
-    for ixpfx in data:
-        try:
-            net = ipaddress.ip_network(ixpfx["prefix"])
-        except:
-            continue
-
-        if v6net.subnet_of(net): break
-
+    ixpfx = _first_ixpfx_covering(v6add, data)
     if ixpfx==None: return None
-    return getixp_by_ixpfx(ixpfx)
+    return one_ixp_by_ixpfx(ixpfx)
 
 
 def unexplode_ip(ip):
@@ -323,9 +462,7 @@ def unexplode_ip(ip):
 
     results = []
     for i in ips:
-        i=re.sub("^0*", "", i)
-        if len(i)==0: i="0"
-        results.append(i)
+        results.append(_LEADING_ZEROS.sub("", i))
 
     result = joinchar.join(results)
     return result
@@ -346,6 +483,55 @@ def getixp_by_ip(ip):
         return None
 
 
+#- For many lookups, querying per address gets expensive. Instead, load all
+#  ixpfx objects once and index them for longest-prefix matching:
+#  version -> [(prefixlen, {network address as int: ixpfx}), ...], longest
+#  prefixlen first. A lookup is then one dict probe per prefix length in use.
+
+_ixpfx_lpm = None
+
+def _ixpfx_index():
+    global _ixpfx_lpm
+    if _ixpfx_lpm != None: return _ixpfx_lpm
+
+    bylen = {4: {}, 6: {}}
+    for ixpfx in pdb_ixpfx_ALL()["data"]:
+        pfx = _parse_prefix(ixpfx["prefix"])
+        if pfx == None: continue
+
+        (version, prefixlen, netint) = pfx
+        bylen[version].setdefault(prefixlen, {}).setdefault(netint, ixpfx)
+
+    _ixpfx_lpm = {v: sorted(bylen[v].items(), reverse=True) for v in bylen}
+    return _ixpfx_lpm
+
+
+def find_ixpfx_by_ip(ip):
+    ''' Find the most specific ixpfx object covering the IP given (v4 or v6)
+        from the full ixpfx list (loaded once, on first use)
+        returns the ixpfx hash (without meta/data stuff), or None
+    '''
+    addr = ipaddress.ip_address(unexplode_ip(ip))
+    addrint = int(addr)
+    bits = addr.max_prefixlen
+
+    for (prefixlen, nets) in _ixpfx_index()[addr.version]:
+        ixpfx = nets.get(addrint & _netmask(bits, prefixlen))
+        if ixpfx != None: return ixpfx
+
+    return None
+
+
+def getixp_by_ip_indexed(ip):
+    ''' Like getixp_by_ip(), but matches against the indexed full ixpfx
+        list instead of querying per address; use when looking up many IPs
+        Returns the ix object hash found, or None
+    '''
+    ixpfx = find_ixpfx_by_ip(ip)
+    if ixpfx == None: return None
+    return one_ixp_by_ixpfx(ixpfx)
+
+
 def first_data_object(obj):
     ''' takes the hash/hash/array/hash object we got from the pdb query
         and returns the first data hash, if available, None otherwise.
@@ -364,8 +550,5 @@ def all_data_objects(obj):
     if not "data" in obj: return None
     if len(obj["data"])==0: return None
 
-    reslist = []
-    for o in obj["data"]: reslist.append(o)
-
-    return reslist
+    return obj["data"][:]           # a copy, the query result may be cached
 
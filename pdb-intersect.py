@@ -66,93 +66,92 @@
 '''
 
 import re
-import sys
+import argparse
 import os
 import ipaddress
 
-from prettytable import PrettyTable
-
-from lib_peeringdb import pdb_net_by_orgid, pdb_net_by_asn, pdb_netixlan_by_netid
-from lib_peeringdb import pdb_net_tree_by_asn, pdb_org_by_id, pdb_net_tree_by_asnlist
-from lib_peeringdb import first_data_object, all_data_objects, pdb_set_credentials
+from collections import defaultdict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 
-#- preset our globals
-asn1 = None
-asn2 = None
-pat1 = None
-pat2 = None
+from lib_peeringdb import pdb_netixlan_by_netid, pdb_net_tree_by_asn, pdb_net_tree_by_asnlist
+from lib_peeringdb import pdb_net_by_asnlist, pdb_net_by_orgidlist, pdb_org_by_idlist
+from lib_peeringdb import all_data_objects, pdb_set_credentials
 
 #------------------------------------------------------------------------------
 
-def get_all_net_for_orgid(orgid, pat=None):
+def _group_by(key, items):
+    ''' returns dict item[key] -> list of the items (hashes) with that value '''
+    groups = defaultdict(list)
+    for item in items: groups[item[key]].append(item)
+    return groups
+
+
+def get_all_nets_for_orgids(orgids):
     '''
-    Return list of net object dicts of objects hanging off orgid,
-    optionally the "notes" field matching pat
+    Return dict org_id -> list of net object dicts of objects hanging off
+    each of the orgids, using a single query
     '''
+    if len(orgids) == 0: return {}
 
-    nets = all_data_objects(pdb_net_by_orgid(orgid))
+    nets = all_data_objects(pdb_net_by_orgidlist(",".join(str(o) for o in orgids)))
+    if nets == None: return {}
 
-    if nets == None: return nets
-    if pat == None: return nets
+    return _group_by("org_id", nets)
 
-    #- fix the pattern for partial matching
-    pat=".*"+pat+".*"
 
-    for net in nets:
-        if not re.match(pat, net["notes"]):
-            nets.remove(net)
+def filter_nets(nets, pat=None):
+    '''
+    Return the list of net object dicts, optionally only those with the
+    "notes" field matching pat
+    '''
+    if not nets: return None
+    if pat == None: return nets
 
-    return nets
+    #- search() does partial matching; notes may be missing or None
+    rx = re.compile(pat)
+    return [net for net in nets if rx.search(net.get("notes") or "")]
 
 
-def get_orgid_for_asn(asn):
-    net = first_data_object(pdb_net_by_asn(asn))
-    if net == None: return None
-    return net["org_id"]
+def get_orgids_for_asns(asns):
+    '''
+    Return dict asn (as int) -> org_id for the asns, using a single query
+    '''
+    nets = all_data_objects(pdb_net_by_asnlist(",".join(str(int(asn)) for asn in asns)))
+    if nets == None: return {}
+    return {net["asn"]: net["org_id"] for net in nets}
 
 #------------------------------------------------------------------------------
 
+def _fmt(ni):
+    ''' formats one netixlan object for an output table cell '''
+    return f"ASN:  {ni['asn']}\nIPv4: {ni['ipaddr4']}\nIPv6: {ni['ipaddr6']}"
+
+
 def ixlan_intersect(netixlan1, netixlan2):
     ''' Finds the common ixlans for the netixlan objects,
-        returns asn1+2 information alongside the ixlan info for matches
+        returns asn1+2 information alongside the ixlan info for matches,
+        as a list of table rows [ix name, asn1 info, asn2 info]
     '''
     #- build lookup dicts for ixlans
-    netixlans1_by_ixlanid = {}
-    netixlans2_by_ixlanid = {}
-
-    for netixlan in netixlan1:
-        key = netixlan["ixlan_id"]
-        if key not in netixlans1_by_ixlanid: netixlans1_by_ixlanid[key] = []
-        netixlans1_by_ixlanid[key].append(netixlan)
-
-    for netixlan in netixlan2:
-        key = netixlan["ixlan_id"]
-        if key not in netixlans2_by_ixlanid: netixlans2_by_ixlanid[key] = []
-        netixlans2_by_ixlanid[key].append(netixlan)
-
-    #- construct sets for each and intersect
-    ixlans1 = set(netixlans1_by_ixlanid.keys())
-    ixlans2 = set(netixlans2_by_ixlanid.keys())
-    ixlans_common = ixlans1.intersection(ixlans2)
-
-    #- construct the resulting set
-    result = {}
-    for ixlanid in ixlans_common:
+    netixlans1_by_ixlanid = _group_by("ixlan_id", netixlan1)
+    netixlans2_by_ixlanid = _group_by("ixlan_id", netixlan2)
+
+    #- construct the resulting rows, for the ixlans common to both
+    #  (intersecting the keys directly, no need for separate sets)
+    rows = []
+    for ixlanid in netixlans1_by_ixlanid.keys() & netixlans2_by_ixlanid.keys():
         netixlans1 = netixlans1_by_ixlanid[ixlanid]
         netixlans2 = netixlans2_by_ixlanid[ixlanid]
 
-        items1 = []
-        items2 = []
-
-        for ni in netixlans1: items1.append("\n".join(["ASN:  "+str(ni['asn']),"IPv4: "+str(ni['ipaddr4']),"IPv6: "+str(ni['ipaddr6'])]))
-        for ni in netixlans2: items2.append("\n".join(["ASN:  "+str(ni['asn']),"IPv4: "+str(ni['ipaddr4']),"IPv6: "+str(ni['ipaddr6'])]))
-
         col1 = netixlans1[0]["name"]
 
-        col2 = "\n\n".join(items1)
-        col3 = "\n\n".join(items2)
+        col2 = "\n\n".join(_fmt(ni) for ni in netixlans1)
+        col3 = "\n\n".join(_fmt(ni) for ni in netixlans2)
 
-        tab.add_row([col1,col2,col3])
+        rows.append([col1,col2,col3])
+
+    return rows
 
 #------------------------------------------------------------------------------
 
@@ -172,112 +171,99 @@ def readcreds_fromconfig(config):
 #------------------------------------------------------------------------------
 
 def getArgs():
-
-    global asn1
-    global asn2
-    global pat1
-    global pat2
-    config=""
-
-    myname = sys.argv.pop(0)
-    arg  = None
-
-    try:
-        arg = sys.argv.pop(0)
-    except:
-        pass
-
-    while arg!= None:
-
-        try:
-            if   arg == "--asn1":   asn1 = sys.argv.pop(0)
-            elif arg == "--asn2":   asn2 = sys.argv.pop(0)
-            elif arg == "--pat1":   pat1 = sys.argv.pop(0)
-            elif arg == "--pat2":   pat2 = sys.argv.pop(0)
-            elif arg == "--config": config = sys.argv.pop(0)
-            else:
-                if   asn1 == None: asn1 = arg
-                elif asn2 == None: asn2 = arg
-                elif pat1 == None: pat1 = arg
-                elif pat2 == None: pat2 = arg
-        except:
-            pass
-
-        #-- now try for the next in the list
-        #   if finished, just set to None and the loop will quit
-        try:
-            arg = sys.argv.pop(0)
-        except:
-            arg = None
-
-
-    if asn1==None or asn2==None:
+    ''' parses the command line (see Synopsis above), sets up authentication
+        returns (asn1, asn2, pat1, pat2), with unset patterns as ""
+    '''
+    parser = argparse.ArgumentParser(
+            description="Find common peering points of two ASNs' orgs in PeeringDB")
+    parser.add_argument("--asn1")
+    parser.add_argument("--asn2")
+    parser.add_argument("--pat1")
+    parser.add_argument("--pat2")
+    parser.add_argument("--config", default="")
+    parser.add_argument("positional", nargs="*", metavar="asn1 asn2 pat1 pat2")
+    args = parser.parse_intermixed_args()     # options may sit between positionals
+
+    #- positional args fill whatever was not given by name, in order
+    positional = list(args.positional)
+    for name in ("asn1", "asn2", "pat1", "pat2"):
+        if getattr(args, name) == None and len(positional) > 0:
+            setattr(args, name, positional.pop(0))
+
+    if args.asn1==None or args.asn2==None:
         print("ERR: Please specify asn1 and asn2")
         exit(1)
 
-    if pat1==None: pat1=""
-    if pat2==None: pat2=""
+    if not (args.asn1.isdigit() and args.asn2.isdigit()):
+        print("ERR: asn1 and asn2 must be numbers")
+        exit(1)
 
     #- get our authentication info ready
-    (pdbuser,pdbpass) = readcreds_fromconfig(config)
+    (pdbuser,pdbpass) = readcreds_fromconfig(args.config)
     if pdbuser != "": pdb_set_credentials(pdbuser,pdbpass)
 
+    return (args.asn1, args.asn2, args.pat1 or "", args.pat2 or "")
 
 
 #------------------------------------------------------------------------------
 # main()
 #------------------------------------------------------------------------------
 
-#- init a PrettyTable object (cool library, folks)
-global tab
-tab = PrettyTable()
-
 #- read the args and init authentication info, setting the API URI accordingly
-getArgs()
+(asn1, asn2, pat1, pat2) = getArgs()
 
 # - get ASNs' org and net objects first (travel UP the tree)
-orgid1 = get_orgid_for_asn(asn1)
-orgid2 = get_orgid_for_asn(asn2)
-asn1_nets = get_all_net_for_orgid(orgid1,pat1)
-asn2_nets = get_all_net_for_orgid(orgid2,pat2)
+#   both sides are looked up together, one query per step
+orgid_by_asn = get_orgids_for_asns([asn1, asn2])
+orgid1 = orgid_by_asn.get(int(asn1))
+orgid2 = orgid_by_asn.get(int(asn2))
 
-if asn1_nets == None:
+nets_by_orgid = get_all_nets_for_orgids({o for o in (orgid1, orgid2) if o != None})
+asn1_nets = filter_nets(nets_by_orgid.get(orgid1), pat1)
+asn2_nets = filter_nets(nets_by_orgid.get(orgid2), pat2)
+
+if not asn1_nets:
     print("No IXPs found for ASN {}".format(asn1))
     exit(1)
 
-if asn2_nets == None:
+if not asn2_nets:
     print("No IXPs found for ASN {}".format(asn2))
     exit(1)
 
-#- get a full tree for all ASN1's org's asns (travel DOWN the tree)
-asns1 = []
-for net in asn1_nets: asns1.append(str(net["asn"]))
-tree1 = all_data_objects(pdb_net_tree_by_asnlist(",".join(asns1)))
+#- collect all ASN1's and ASN2's org's asns, without duplicates
+asns1 = {str(net["asn"]) for net in asn1_nets}
+asns2 = {str(net["asn"]) for net in asn2_nets}
+
+#- get a full tree for both org's asns (travel DOWN the tree), and read the
+#  org objects to extract the name, for proper output - all in one go
+#  (lists sorted, so the same asns always make the same, cacheable, URL)
+with ThreadPoolExecutor() as pool:
+    q_tree = pool.submit(pdb_net_tree_by_asnlist, ",".join(sorted(asns1 | asns2)))
+    q_orgs = pool.submit(pdb_org_by_idlist, ",".join(sorted({str(orgid1), str(orgid2)})))
 
-#- get a full tree for all ASN2's org's asns (travel DOWN the tree)
-asns2 = []
-for net in asn2_nets: asns2.append(str(net["asn"]))
-tree2 = all_data_objects(pdb_net_tree_by_asnlist(",".join(asns2)))
+#- split the tree up again; both orgs might share asns (or be the same)
+tree = all_data_objects(q_tree.result()) or []
+tree1 = [net for net in tree if str(net["asn"]) in asns1]
+tree2 = [net for net in tree if str(net["asn"]) in asns2]
 
-#- actually read the org objects to extract the name, for proper output
-org1 = first_data_object(pdb_org_by_id(orgid1))
-org2 = first_data_object(pdb_org_by_id(orgid2))
+orgs = {org["id"]: org for org in all_data_objects(q_orgs.result()) or []}
+org1 = orgs[orgid1]
+org2 = orgs[orgid2]
+
+#- init a PrettyTable object (cool library, folks); only imported now that
+#  there is something to print, which keeps early exits quick
+from prettytable import PrettyTable
+tab = PrettyTable()
 tab.field_names = ["IX", org1["name"], org2["name"]+"."]
 
 #- get ixlan list for the ASNs hanging off asn1 (travel DOWN per ASN)
-netixlan1 = []
-for net in tree1:
-    ixlanset = net["netixlan_set"]
-    netixlan1 += ixlanset
+netixlan1 = list(chain.from_iterable(net["netixlan_set"] for net in tree1))
 
 #- and for asn2 (travel DOWN per ASN)
-netixlan2 = []
-for net in tree2:
-    ixlanset = net["netixlan_set"]
-    netixlan2 += ixlanset
+netixlan2 = list(chain.from_iterable(net["netixlan_set"] for net in tree2))
 
-#- intersect by ixlan_id, intersect() puts results into the tab object
-ixlan_intersect(netixlan1, netixlan2)
+#- intersect by ixlan_id, and put the results into the tab object in one go
+tab.add_rows(ixlan_intersect(netixlan1, netixlan2))
 
 #- format and output tab object output in a nice fashion (yes, this is great)
 tab.hrules = 1